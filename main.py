@@ -1,26 +1,84 @@
+import functools
 import io
-import json
+import logging
 import os
+import queue
 import re
-import traceback
-from typing import List, Optional, Dict, Any, Union
+import string
+import time
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+from typing import Annotated, List, Optional, Dict, Any, Union
 import asyncio  # 【新增】導入 asyncio 模組
+import anyio.to_thread
+import orjson
 
 # --- 1. FastAPI 和 Pydantic 相關導入 ---
-from fastapi import FastAPI, Form, File, UploadFile, HTTPException
+from fastapi import FastAPI, Form, File, UploadFile, HTTPException, Query, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, ValidationError # 【新增】導入 ValidationError
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, BeforeValidator, Field, TypeAdapter, ValidationError # 【新增】導入 ValidationError
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 # --- Google Cloud 和 Vertex AI 相關導入 ---
 from google.cloud import vision
+from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcAsyncIOTransport
 from google.cloud import storage
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part, Tool, grounding, HarmCategory, HarmBlockThreshold
+from vertexai.generative_models import GenerativeModel, GenerationConfig, Part, SafetySetting, Tool, grounding, HarmCategory, HarmBlockThreshold
+
+# --- 圖片處理 ---
+from PIL import Image, ImageOps
 
 # --- 環境變數加載 ---
 from dotenv import load_dotenv
 load_dotenv()
 
+# --- 配置 ---
+# 環境變數只在啟動時讀取並驗證一次，之後所有程式碼都讀取這個凍結的設定物件
+RequiredStr = Annotated[str, Field(min_length=1)]
+
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(frozen=True)
+
+    gcp_project_id: RequiredStr
+    gcp_location: str = "us-central1" # 範例: us-central1
+    gemini_model_name: RequiredStr
+    datastore_id: RequiredStr
+    gcs_prompt_bucket_name: RequiredStr
+    log_level: str = "INFO"
+    # 單一上傳圖片的大小上限 (Vision API 對單張圖片的限制為 20 MB)
+    max_upload_bytes: int = 20 * 1024 * 1024
+    # 整個請求主體的大小上限 (一次可上傳多張圖片)，超過時在解析 multipart 之前就回傳 413
+    max_request_bytes: int = 100 * 1024 * 1024
+    # 設為 true 時學生作業圖片不經 Vision OCR，直接交由 Gemini 從圖片辨識內容
+    use_gemini_only_ocr: bool = False
+
+@functools.lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    # 缺少必要的環境變數 (GCP_PROJECT_ID, GEMINI_MODEL_NAME, DATASTORE_ID, GCS_PROMPT_BUCKET_NAME)
+    # 時會拋出 ValidationError (ValueError 的子類別)
+    return Settings()
+
+settings = get_settings()
+
+# --- 日誌設定 ---
+# 記錄經由 QueueHandler 放入佇列，由背景執行緒的 QueueListener 寫出到 stdout，
+# 事件迴圈上的程式碼不會因為同步寫入 stdout 而被阻塞
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level.upper())
+logger.propagate = False
+_log_queue: queue.Queue = queue.Queue(-1)
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+logger.addHandler(QueueHandler(_log_queue))
+log_listener = QueueListener(_log_queue, _log_stream_handler)
+log_listener.start()
+
 # ==============================================================================
 # 2. PYDANTIC 模型 (保持不變)
 # ==============================================================================
@@ -93,12 +151,21 @@ class SectionFeedback(BaseModel):
     questions_feedback: List[QuestionFeedback]
     section_summary: str
 
+def _score_to_str(value: Any) -> Any:
+    """AI 回傳的分數可能是數字或 "20/25" 之類的字串，數字一律轉成字串。"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return value
+
+# 單一 str 型別加上前置轉換，避免 Union[str, int, float] 逐一嘗試各成員的驗證成本
+ScoreValue = Annotated[str, BeforeValidator(_score_to_str)]
+
 class ScoreBreakdownItem(BaseModel):
     section: str
-    # 【最終修正】允許 max_score 是字串、整數或浮點數
-    max_score: Union[str, int, float]
-    # 【最終修正】允許 obtained_score 是字串、整數或浮點數
-    obtained_score: Union[str, int, float]
+    # 【最終修正】允許 max_score 是字串、整數或浮點數 (數字會轉為字串)
+    max_score: ScoreValue
+    # 【最終修正】允許 obtained_score 是字串、整數或浮點數 (數字會轉為字串)
+    obtained_score: ScoreValue
 
 class WorksheetResponse(BaseModel):
     submissionType: str = Field(..., example="學習單批改")
@@ -117,18 +184,90 @@ class WorksheetResponse(BaseModel):
 # 使用 Union 來定義路由可能返回的多種類型，增強類型提示
 ApiResponse = Union[ParagraphResponse, QuizResponse, WorksheetResponse]
 
+# 預先編譯好的驗證器/序列化器，每個請求直接重用，不必重新走訪 schema
+PARAGRAPH_ADAPTER = TypeAdapter(ParagraphResponse)
+QUIZ_ADAPTER = TypeAdapter(QuizResponse)
+WORKSHEET_ADAPTER = TypeAdapter(WorksheetResponse)
+
+# 提交類型 -> 對應的回應驗證器
+RESPONSE_ADAPTERS: Dict[str, TypeAdapter] = {
+    '段落寫作評閱': PARAGRAPH_ADAPTER,
+    '測驗寫作評改': QUIZ_ADAPTER,
+    '學習單批改': WORKSHEET_ADAPTER,
+    '讀寫習作評分': WORKSHEET_ADAPTER,
+}
+
 
 # ==============================================================================
 # 3. FastAPI 應用初始化與配置 (保持不變)
 # ==============================================================================
 # ... (此處省略 FastAPI app 和 Google Cloud client 的初始化，與前一版本相同) ...
+# --- 以 orjson 序列化的 JSON 回應 (回應中大量中文，orjson 比標準庫 json 快得多) ---
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+# anyio 執行緒池大小 (同步的 GCS 呼叫透過 run_in_threadpool 在此執行)
+THREADPOOL_SIZE = 64
+
+# --- 應用程式生命週期：在事件迴圈內建立/關閉非同步客戶端 ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # GCS 等同步呼叫會被丟到 anyio 的執行緒池；預設 40 個執行緒對 I/O 密集的請求偏少
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+    # gRPC asyncio 通道必須在執行中的事件迴圈內建立，因此不能在模組層級初始化
+    try:
+        transport = ImageAnnotatorGrpcAsyncIOTransport(credentials=google_credentials, channel=create_vision_channel)
+        app.state.vision_client = vision.ImageAnnotatorAsyncClient(transport=transport)
+        logger.info("Vision 非同步客戶端初始化成功。")
+    except Exception:
+        logger.exception("嚴重錯誤: 初始化 Vision 非同步客戶端失敗")
+
+    # 【新增】Prompt 模板與標準答案檔案在啟動時就載入快取，GCS 讀取不再出現在第一批請求的關鍵路徑上
+    try:
+        await prefetch_gcs_files()
+    except Exception:
+        logger.exception("預先載入 GCS 檔案失敗，將於請求時再讀取")
+    yield
+    if getattr(app.state, "vision_client", None) is not None:
+        await app.state.vision_client.transport.close()
+    log_listener.stop()
+
 # --- 初始化 FastAPI 應用 ---
 app = FastAPI(
     title="AI 英文家教 API",
     description="使用 Vertex AI Gemini 對多種類型的英文寫作作業進行評分。",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
+# --- 請求主體大小限制 (純 ASGI 中介軟體) ---
+class ContentSizeLimitMiddleware:
+    """依 Content-Length 標頭在讀取請求主體之前拒絕過大的請求，上傳內容不會被寫入暫存檔。"""
+
+    def __init__(self, app, max_content_size: int):
+        self.app = app
+        self.max_content_size = max_content_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > self.max_content_size:
+                        response = ORJSONResponse(
+                            {"detail": f"請求內容過大，上限為 {self.max_content_size // (1024 * 1024)} MB。"},
+                            status_code=413
+                        )
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+# 先加入的中介軟體在內層：放在 CORS 之前，413 回應才會帶有 CORS 標頭，瀏覽器端讀得到錯誤訊息
+app.add_middleware(ContentSizeLimitMiddleware, max_content_size=settings.max_request_bytes)
+
 # --- 配置 CORS (跨來源資源共用) 中介軟體 ---
 app.add_middleware(
     CORSMiddleware,
@@ -139,450 +278,306 @@ app.add_middleware(
 )
 
 
-# --- 配置 ---
-GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
-GCP_LOCATION = os.environ.get("GCP_LOCATION", "us-central1") # 範例: us-central1
-GEMINI_MODEL_NAME = os.environ.get("GEMINI_MODEL_NAME")
-DATASTORE_ID = os.environ.get("DATASTORE_ID")
-GCS_PROMPT_BUCKET_NAME = os.environ.get("GCS_PROMPT_BUCKET_NAME")
+# --- Vertex AI Search 資料儲存庫 ---
+DATASTORE_COLLECTION_LOCATION = "global"
+DATASTORE_RESOURCE_NAME = f"projects/{settings.gcp_project_id}/locations/{DATASTORE_COLLECTION_LOCATION}/collections/default_collection/dataStores/{settings.datastore_id}"
 
-# 檢查必要的環境變數是否已設定
-if not all([GCP_PROJECT_ID, GEMINI_MODEL_NAME, DATASTORE_ID, GCS_PROMPT_BUCKET_NAME]):
-    raise ValueError("一個或多個必要的環境變數未設定 (GCP_PROJECT_ID, GEMINI_MODEL_NAME, DATASTORE_ID, GCS_PROMPT_BUCKET_NAME)")
 
-DATASTORE_COLLECTION_LOCATION = "global"
-DATASTORE_RESOURCE_NAME = f"projects/{GCP_PROJECT_ID}/locations/{DATASTORE_COLLECTION_LOCATION}/collections/default_collection/dataStores/{DATASTORE_ID}"
+# GCS 客戶端底層 requests 連線池的大小 (預設只有 10 條連線，並發請求時會反覆做 TLS 握手)
+GCS_HTTP_POOL_CONNECTIONS = 32
+GCS_HTTP_POOL_MAXSIZE = 128
+
+# 所有 Google Cloud 客戶端共用同一組憑證 (cloud-platform 涵蓋 Vertex AI、Vision 與 GCS)
+GOOGLE_CLOUD_SCOPES = ("https://www.googleapis.com/auth/cloud-platform",)
+
+# Vision gRPC 通道的 keepalive：長時間的 OCR 請求期間定期 ping，及早發現已斷線的 HTTP/2 連線
+VISION_GRPC_KEEPALIVE_OPTIONS = [("grpc.keepalive_time_ms", 30000), ("grpc.keepalive_timeout_ms", 10000)]
 
+def create_vision_channel(*args, options=(), **kwargs):
+    """在 transport 預設的通道參數 (訊息大小上限等) 之外加上 keepalive 設定。"""
+    return ImageAnnotatorGrpcAsyncIOTransport.create_channel(*args, options=[*options, *VISION_GRPC_KEEPALIVE_OPTIONS], **kwargs)
+
+def build_storage_http_session(credentials) -> AuthorizedSession:
+    """建立帶有較大連線池的已授權 HTTP session，供 storage.Client 重用連線。"""
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=GCS_HTTP_POOL_CONNECTIONS, pool_maxsize=GCS_HTTP_POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    return session
+
+# --- Gemini 呼叫的固定參數 (模組層級常數，建立模型時綁定一次，所有請求共用) ---
+# 使用 SDK 的型別物件而非 dict：SDK 直接取用內部的 proto，不必每次呼叫都從 dict 轉換
+GENERATION_CONFIG = GenerationConfig(temperature=0.1, top_p=0.5, max_output_tokens=16348)
+SAFETY_SETTINGS = tuple(
+    SafetySetting(category=category, threshold=HarmBlockThreshold.BLOCK_NONE)
+    for category in (
+        HarmCategory.HARM_CATEGORY_UNSPECIFIED,
+        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+        HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+        HarmCategory.HARM_CATEGORY_HARASSMENT,
+        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+    )
+)
 
 # --- 在應用程式啟動時初始化 Google Cloud 客戶端 ---
 try:
-    vertexai.init(project=GCP_PROJECT_ID, location=GCP_LOCATION)
-    vision_client = vision.ImageAnnotatorClient()
-    storage_client = storage.Client(project=GCP_PROJECT_ID)
+    # 【新增】只在啟動時解析一次預設憑證，Vertex AI、GCS 與 Vision 共用同一個憑證物件 (與其存取權杖快取)
+    google_credentials, _ = google.auth.default(scopes=GOOGLE_CLOUD_SCOPES)
+    # 明確指定 gRPC 傳輸 (HTTP/2 長連線，多個請求共用同一個通道)
+    vertexai.init(project=settings.gcp_project_id, location=settings.gcp_location,
+                  credentials=google_credentials, api_transport="grpc")
+    storage_client = storage.Client(project=settings.gcp_project_id, credentials=google_credentials,
+                                    _http=build_storage_http_session(google_credentials))
 
-    gemini_model = GenerativeModel(GEMINI_MODEL_NAME)
     search_tool = Tool.from_retrieval(
         grounding.Retrieval(grounding.VertexAISearch(datastore=DATASTORE_RESOURCE_NAME))
     )
-    tools_list = [search_tool]
-    print("Vertex AI 和 Google Cloud 客戶端初始化成功。")
+    TOOLS_LIST = [search_tool]
+    # 【修改】生成參數、安全設定與工具在建立模型時綁定，之後每次呼叫都不必再傳入
+    gemini_model = GenerativeModel(
+        settings.gemini_model_name,
+        generation_config=GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS,
+        tools=TOOLS_LIST
+    )
+    logger.info("Vertex AI 和 Google Cloud 客戶端初始化成功。")
 
-except Exception as e:
-    print(f"嚴重錯誤: 初始化 Google Cloud 客戶端失敗: {e}")
-    traceback.print_exc()
+except Exception:
+    logger.exception("嚴重錯誤: 初始化 Google Cloud 客戶端失敗")
     # 在實際應用中，如果客戶端初始化失敗，您可能希望程式退出
-    
-# --- 用於生成 JSON 結構的模擬數據 (保留自原始碼，用於生成 Prompt) ---
-mock_paragraph_data_for_structure = {
-        "submissionType": "段落寫作評閱",
-        "error_analysis": [
-            {
-            "original_sentence": "With my heart beating rapidly in excitement, I tried to look past the sea olf people and see through the large glass windows of the department store.",
-            "error_type": "拼寫錯誤",
-            "error_content": "oIf 應為 of，departiment 應為 department",
-            "suggestion": "With my heart beating rapidly in excitement, I tried to look past the sea of people and see through the large glass windows of the department store. (olf 應為 of, department store 通常是一個詞組，但此處 department 單獨出現可能指部門，如果指百貨公司則應為 department store)"
-            },
-            {
-            "original_sentence": "Every person waiting outside had the same goal as mine to take advantage of the huge sales the shop was offering.",
-            "error_type": "文法錯誤 (比較結構)",
-            "error_content": "mine 後面應加上 is 或 was，以完成比較。",
-            "suggestion": "Every person waiting outside had the same goal as mine: to take advantage of the huge sales the shop was offering. (在 mine 後面加上冒號或 is/was 來完成比較結構會更清晰)"
-            },
-            {
-            "original_sentence": "However, many other customers had beaten me to the task.",
-            "error_type": "用字遣詞 (表達不自然)",
-            "error_content": "beaten me to the task 略顯不自然，可替換為更常見的表達方式。",
-            "suggestion": "However, many other customers had arrived earlier / gotten there before me. ('beaten me to the task' 略顯不自然，可替換為更常見的表達方式)"
-            },
-            {
-            "original_sentence": "Therefore, I stood slightly farther away from the enterance than I had planned,but that did not put out my ambition to purchase as many items as possible.",
-            "error_type": "拼寫錯誤，標點符號",
-            "error_content": "enterance 應為 entrance，but 前面的逗號應改為分號或句號",
-            "suggestion": "Therefore, I stood slightly farther away from the entrance than I had planned; but that did not diminish my ambition to purchase as many items as possible."
-            },
-            {
-            "original_sentence": "The constant chatter around me became impatient as time trickled by.",
-            "error_type": "用字遣詞",
-            "error_content": "chatter 本身不會感到 impatient，應是人感到 impatient。",
-            "suggestion": "I became impatient with the constant chatter around me as time trickled by."
-            }
-        ],
-        "rubric_evaluation": {
-            "structure_performance": [
-            {
-                "item": "Task Fulfillment and Purpose",
-                "score": 8,
-                "comment": "很好地完成了任務，描述了一次購物的經歷，並表達了情感的轉變。主題明確。"
-            },
-            {
-                "item": "Topic Sentence and Main Idea",
-                "score": 7,
-                "comment": "段落中有多個主題句，但主旨明確，圍繞著購物經歷和情感轉變展開。"
-            },
-            {
-                "item": "Supporting Sentences and Argument Development",
-                "score": 7,
-                "comment": "細節描述豐富，但部分細節可以更精煉，使論述更集中。"
-            },
-            {
-                "item": "Cohesion and Coherence",
-                "score": 7,
-                "comment": "整體連貫性不錯，但部分句子之間的銜接可以更自然。"
-            },
-            {
-                "item": "Concluding Sentence and Closure",
-                "score": 8,
-                "comment": "結尾總結了整件事情，並點明了主題，有很好的收尾。"
-            }
-            ],
-            "content_language": [
-            {
-                "item": "Depth of Analysis and Critical Thinking",
-                "score": 7,
-                "comment": "對情感的轉變有一定程度的分析，但可以更深入地挖掘內心感受。"
-            },
-            {
-                "item": "Grammar and Sentence Structure",
-                "score": 6,
-                "comment": "文法基礎尚可，但存在一些錯誤，需要加強練習。"
-            },
-            {
-                "item": "Vocabulary and Word Choice",
-                "score": 7,
-                "comment": "詞彙使用恰當，但可以嘗試使用更多樣化的詞彙。"
-            },
-            {
-                "item": "Spelling, Punctuation, and Mechanics",
-                "score": 6,
-                "comment": "拼寫和標點符號方面存在一些錯誤，需要仔細檢查。"
-            },
-            {
-                "item": "Persuasive Effectiveness and Audience Awareness",
-                "score": 7,
-                "comment": "故事具有一定的感染力，能引起讀者的共鳴。"
-            }
-            ]
-        },
-        "overall_assessment": {
-            "total_score": "68/100",
-            "suggested_grade": "C+",
-            "grade_basis": "依據七年級標準評量。",
-            "general_comment": "整體而言，作文內容生動有趣，但文法和拼寫方面仍需加強。繼續努力，注意細節，相信你會寫得更好！"
-        },
-        "model_paragraph": "With my heart beating rapidly in excitement, I tried to look past the sea of people and see through the large glass windows of the department store. Every person waiting outside had the same goal as mine: to take advantage of the huge sales the shop was offering. I had arrived early in the morning, hoping to be close to the doors. However, many other customers had arrived even earlier. Therefore, I stood slightly farther away from the entrance than I had planned, but that did not diminish my ambition to purchase as many items as possible. I became impatient with the constant chatter around me as time trickled by. Suddenly, the glass doors burst open. I watched as men and women in front of me flooded into the store. All around me, people pushed each other, eager to get in. We were like sardines in a box as we crammed through the narrow doors. Being too preoccupied to notice my surroundings, I tripped on the edge of the carpet. To my disappointment, I found myself sprawled on the floor, watching as people grabbed goods off the shelves. My ankle was sprained, and it was as though all my waiting had gone to waste. Even worse, no one even stopped to help me up. Limping around the store, I realized I couldn't get to the discounted items fast enough. Although I had arrived earlier than most, my carelessness had resulted in a disadvantage. I saw a number of products snatched up by quicker hands, and people watched as other people filled up carts and baskets. Consequently, my former excitement faded away, replaced by regret. How I wish I had not come! Having given up hope, I slowly made my way to the exit, my hands empty and my wallet full. Stepping out the glass doors, I noticed in the corner of my eye several people holding out signs. Curious, I went to check it out. It was a charity for stray dogs and they had brought puppies with them. I couldn't resist the urge to caress the canines' heads. Wagging their tails enthusiastically, they licked my palms. I giggled, all my disappointment dissolved like salt in water. After playing with them for a while, I pulled out my purse and donated all the money I had planned to spend. At the end of the day, I did go home with my purse empty. However, instead of products, I had a cute puppy in my hands. What a wonderful day it had been.",
-        "teacher_summary_feedback": "你的作文內容很有趣，描述了一次難忘的購物經歷。故事的敘述流暢，情感表達也比較自然。不過，在文法和拼寫方面還有進步的空間。多加練習，注意細節，相信你會寫得更好！"
-        }
-mock_quiz_data_for_structure = {
-        "submissionType": "測驗寫作評改",
-        "error_analysis_table": [
-            {
-            "original_sentence": "It was the anniversary of the mall where a mutitude of discounts took place.",
-            "error_type": "拼寫錯誤 / 用字選擇",
-            "problem_description": "單字 'mutitude' 拼寫錯誤，應為 'multitude'。同時，'took place' 用於描述折扣的發生略顯生硬，'were offered' 更自然。",
-            "suggestion": "It was the anniversary of the mall where a multitude of discounts were offered."
-            },
-            {
-            "original_sentence": "Some people waited patiently in line and killed their time by being phubbers, whereas others couldn't stand the taxing process of waiting in line and gave up.",
-            "error_type": "用字選擇 (非正式/俚語)",
-            "problem_description": "'Phubbers' 是較新的非正式詞彙，不一定所有讀者都理解，建議在測驗寫作中使用更通俗、正式的表達，例如 'using their phones' 或 'distracted by their phones'。'taxing process' 表達準確。",
-            "suggestion": "Some people waited patiently in line and killed their time by using their phones, whereas others couldn't stand the taxing process of waiting in line and gave up."
-            },
-            {
-            "original_sentence": "To make matters worse, some impatient customers even lost their temper and tried to cut in lines, causing disputes and leaving the mall in chaos.",
-            "error_type": "固定用法",
-            "problem_description": "應為'cut in line'。",
-            "suggestion": "To make matters worse, some impatient customers even lost their temper and tried to cut in line, causing disputes and leaving the mall in chaos."
-            },
-            {
-            "original_sentence": "Others either surrendered or got cut off after the mall closed.",
-            "error_type": "用詞選擇",
-            "problem_description": "'surrendered'在此情境下稍正式，可用'gave up'。",
-            "suggestion": "Others either gave up or got cut off after the mall closed."
-            }
-        ],
-        "summary_feedback_for_student": 
-        {
-            "summary_feedback":"你的作文整體結構完整，敘事流暢，能夠生動地描寫場景和人物心理。詞彙使用豐富，展現了不錯的英文基礎。不過，在拼寫和用詞的準確性上還有進步空間。注意檢查拼寫錯誤，並選擇更貼切、自然的詞彙，可以讓你的作文更上一層樓。",
-            "total_score_display": "92 / 100",
-            "suggested_grade_display": "A-",
-            "grade_basis_display": "根據國中三年級寫作標準"
-        },
-        "revised_demonstration": 
-        {
-            "original_with_errors_highlighted": "<strong>Anxiously</strong> waiting, legions of people stood in front of the gate. It was the anniversary of the mall where a <strong>mutitude</strong> of discounts took place. When it was about eight AM, a <strong>staff</strong> of the mall approached the door. No sooner did he open the door than the crowd dashed in. They entered every store, took what they wanted to <strong>bry</strong>, and <strong>literally</strong> went on a shopping spree. Thousands of purchases were made and everyone thought that they could shop to their hearts' <strong>contert</strong>. However, the story unfolded in the opposite way. As more and more people got into the mall, not only were the stores packed, but the line waiting in front of the cashier stretched for more than ten meters. The smiles on people's face and their <strong>electricfied</strong> mood <strong>withered</strong> as time went by. The time spent on <strong>shoppirg</strong> was actually less than the time spent on waiting. Given this frustrating condition, the crowd had different reactions. Some people waited patiently in line and killed their time by being <strong>phubbers</strong>, whereas others couldn't stand the <strong>taxing</strong> process of waiting in line and gave up. To make matters worse, some impatient customers even lost their temper and tried to cut in lines, causing disputes and leaving the mall in chaos. At the end of the day, only one third of the customers made it to pay for what they had taken. Others either <strong>surrendered</strong> or got cut off after the mall closed. The next day, this incident was reported by the news, and people started to reflect. Eventually, most of them reached the same conclusion that we should no longer blindly follow the crowd and get fooled by the marketing strategies of the mall. After all, no one wants to wait in line for hours and wind up wasting their time.",
-            "suggested_revision": "Anxiously waiting, legions of people stood in front of the gate. It was the anniversary of the mall where a large number of discounts were offered. When it was about eight AM, an employee of the mall approached the door. No sooner did he open the door than the crowd dashed in. They entered every store, took what they wanted to buy, and went on a shopping spree. Thousands of purchases were made and everyone thought that they could shop to their hearts' content. However, the story unfolded in the opposite way. As more and more people got into the mall, not only were the stores packed, but the line waiting in front of the cashier stretched for more than ten meters. The smiles on people's faces and their electrified mood faded as time went by. The time spent on shopping was actually less than the time spent on waiting. Given this frustrating condition, the crowd had different reactions. Some people waited patiently in line and killed their time by using their phones, whereas others couldn't stand the difficult process of waiting in line and gave up. To make matters worse, some impatient customers even lost their temper and tried to cut in lines, causing disputes and leaving the mall in chaos. At the end of the day, only one third of the customers made it to pay for what they had taken. Others either gave up or got cut off after the mall closed. The next day, this incident was reported by the news, and people started to reflect. Eventually, most of them reached the same conclusion that we should no longer blindly follow the crowd and get fooled by the marketing strategies of the mall. After all, no one wants to wait in line for hours and wind up wasting their time."
-        },
-        "positive_learning_feedback": "你的寫作展現了很強的敘事能力和豐富的詞彙量，能夠清楚地表達想法，讓讀者感受到你的思考與情感。即使過程中出現了一些小錯誤，也完全不影響整體的表現。請不要因此氣餒，因為每一次寫作的練習，都是一次難能可貴的學習與成長機會。透過不斷地修正與嘗試，你會更了解自己的風格，也會漸漸掌握如何讓語言更具感染力。繼續保持你對寫作的熱情與好奇心，相信你會在這條路上越走越穩，越寫越好，未來也有機會創作出更多令人印象深刻的作品！"
-        }
-mock_learning_sheet_structure = {
-        "submissionType": "學習單批改",
-        "title": "📋 學習單批改結果",
-        "sections": [
-            {
-            "section_title": "[考卷上的大標題(粗體)]",
-            "questions_feedback": [
-                {
-                "question_number": "1",
-                "student_answer": "[學生實際的完整答案]",
-                "is_correct": "[✅/❌]",
-                "comment": "[根據學生答案正確或錯誤生成內容]",
-                "correct_answer": "[[標準答案]中對應題號的正確答案]",
-                "answer_source_query":"[標準答案實際出處(search_tool(query=''))]",
-                "answer_source_content":"[標準答案實際的內容(格式範例:Lesson 1/Pre-listening Questions/1:Yes, there are two sports teams in my school. They are the soccer team and the basketball team.)]"
-                },
-                {
-                "question_number": "2",
-                "student_answer": "[學生實際的完整答案]",
-                "is_correct": "[✅/❌]",
-                "comment": "[根據學生答案正確或錯誤生成內容]",
-                "correct_answer": "[[標準答案]中對應題號的正確答案]",
-                "answer_source_query":"[標準答案實際出處(search_tool(query=''))]",
-                "answer_source_content":"[標準答案實際的內容(格式範例:Lesson 1/Pre-listening Questions/2:Yes, I play sports in my free time.)]"
-                }
-            ],
-            "section_summary": "[根據學生在此部分的表現生成總結]"
-            },
-            {
-            "section_title": "[考卷上的大標題(粗體)]",
-            "questions_feedback": [
-                {
-                "question_number": "1",
-                "student_answer": "[學生實際的完整答案]",
-                "is_correct": "[✅/❌]",
-                "comment": "[根據學生答案正確或錯誤生成內容]",
-                "correct_answer": "[[標準答案]中對應題號的正確答案]",
-                "answer_source_query":"[標準答案實際出處(search_tool(query=''))]",
-                "answer_source_content":"[標準答案實際的內容(格式範例:Lesson 1/While-listening Notes/1:Do you practice basketball after school every day)]"
-                }
-            ],
-            "section_summary": "[根據學生在此部分的表現生成總結]"
-            },
-            {
-            "section_title": "[考卷上的大標題(粗體)]",
-            "questions_feedback": [
-                {
-                "question_number": "1",
-                "student_answer": "[學生實際的完整答案]",
-                "is_correct": "[✅/❌]",
-                "comment": "[根據學生答案正確或錯誤生成內容]",
-                "correct_answer": "[[標準答案]中對應題號的正確答案]",
-                "answer_source_query":"[標準答案實際出處(search_tool(query=''))]",
-                "answer_source_content":"[標準答案實際的內容(格式範例:Lesson 1/Dialogue Mind Map/1:basketball]"
-                }
-            ],
-            "section_summary": "[根據學生在此部分的表現生成總結，並依照III.的配分計分]"
-            },
-            {
-            "section_title": "[考卷上的大標題(粗體)]",
-            "questions_feedback": [ 
-                {
-                "question_number": "1", 
-                "student_answer": "[學生實際的答案]",
-                "is_correct": "[✅/❌]", 
-                "comment": "[根據學生答案正確或錯誤生成內容]",
-                "correct_answer": "[[標準答案]中對應題號的正確答案]",
-                "answer_source_query":"[標準答案實際出處(search_tool(query=''))]",
-                "answer_source_content":"[標準答案實際的內容(格式範例:Lesson 1/Post-listening Questions and Answers/1:They worry about their grades at school.)]"
-                }
-            ],
-            "section_summary": "[根據學生在此部分的表現生成總結]"
-            }
-        ],
-        "overall_score_summary_title": "✅ 總分統計與等第建議",
-        "score_breakdown_table": [
-            {
-            "section": "[考卷上的大標題(粗體)]",
-            "max_score": "[根據考卷上的配分]",
-            "obtained_score": "[計算此部分得分]"
-            },
-            {
-            "section": "[考卷上的大標題(粗體)]",
-            "max_score": "[根據考卷上的配分]",
-            "obtained_score": "[計算此部分得分]"
-            },
-            {
-            "section": "[考卷上的大標題(粗體)]",
-            "max_score": "[根據考卷上的配分]",
-            "obtained_score": "[計算此部分得分]"
-            },
-            {
-            "section": "[考卷上的大標題(粗體)]",
-            "max_score": "[根據考卷上的配分]",
-            "obtained_score": "[計算此部分得分]"
-            }
-        ],
-        "final_total_score_text": "總分：100 學生分數：[學生得分]",
-        "final_suggested_grade_title": "🔺等第建議",
-        "final_suggested_grade_text": "[根據總分生成建議等第與說明]",
-        "overall_feedback_title": "📚 總結性回饋建議（可複製給學生）",
-        "overall_feedback": "[針對學生考卷的作答整體表現生成正面總結性回饋]"
-        }
-
-        # 新增：讀寫習作評分的 JSON 結構範例
-mock_reading_writing_structure = {
-        "submissionType": "讀寫習作評分",
-        "title": "📘讀寫習作批改結果",
-        "sections": [
-            {
-            "section_title": "I. [考卷上的大標題與配分]",
-            "questions_feedback": [
-                {
-                "question_number": "1",
-                "student_answer": "[學生實際的答案]",
-                "is_correct": "[✅/❌]",
-                "comment": "[根據學生答案正確或錯誤生成內容]",
-                "correct_answer": "[[學生年級]習作標準答案]",
-                "answer_source_query":"[標準答案實際出處(search_tool(query=''))]",
-                "answer_source_content":"[標準答案實際的內容(格式範例:Book 5/Lesson 2/I Read and Write/1:interests)]"
-                },
-                {
-                "question_number": "2",
-                "student_answer": "[學生實際的答案]",
-                "is_correct": "[✅/❌]",
-                "comment": "[根據學生答案正確或錯誤生成內容]",
-                "correct_answer": "[[學生年級]習作標準答案]",
-                "answer_source_query":"[標準答案實際出處(search_tool(query=''))]",
-                "answer_source_content":"[標準答案實際的內容(格式範例:Book 5/Lesson 2/I Read and Write/2:reason)]"
-                }
-            ],
-            "section_summary": "[根據學生在此部分的表現生成總結，並依照I.的配分計分]"
-            },
-            {
-            "section_title": "II. [考卷上的大標題與配分]",
-            "questions_feedback": [
-                {
-                "question_number": "1",
-                "student_answer": "[學生實際的答案]",
-                "is_correct": "[✅/❌]",
-                "comment": "[根據學生答案正確或錯誤生成內容]",
-                "correct_answer": "[[學生年級]習作標準答案]",
-                "answer_source_query":"[標準答案實際出處(search_tool(query=''))]",
-                "answer_source_content":"[標準答案實際的內容(格式範例:Book 5/Lesson 2/II Look and Fill In/1:tiring)]"
-                }
-            ],
-            "section_summary": "[根據學生在此部分的表現生成總結，並依照II.的配分計分]"
-            },
-            {
-            "section_title": "III. [考卷上的大標題與配分]",
-            "questions_feedback": [
-                {
-                "question_number": "1",
-                "student_answer": "[學生實際的答案]",
-                "is_correct": "[✅/❌]",
-                "comment": "[根據學生答案正確或錯誤生成內容]",
-                "correct_answer": "[[學生年級]習作標準答案]",
-                "answer_source_query":"[標準答案實際出處(search_tool(query=''))]",
-                "answer_source_content":"[標準答案實際的內容(格式範例:Book 5/Lesson 2/III Read and Write/1:James thought (that) Linda would like the gift.]"
-                }
-            ],
-            "section_summary": "[根據學生在此部分的表現生成總結，並依照III.的配分計分]"
-            },
-            {
-            "section_title": "IV.[考卷上的大標題與配分]",
-            "questions_feedback": [ 
-                {
-                "question_number": "1", 
-                "student_answer": "[學生實際的答案]",
-                "is_correct": "[✅/❌]", 
-                "comment": "[根據學生答案正確或錯誤生成內容]",
-                "correct_answer": "[[學生年級]習作標準答案]",
-                "answer_source_query":"[標準答案實際出處(search_tool(query=''))]",
-                "answer_source_content":"[標準答案實際的內容(格式範例:Book 5/Lesson 2/IV Fill In/1:reasons / choice)]"
-                }
-            ],
-            "section_summary": "[根據學生在此部分的表現生成總結，並依照IV.的配分計分]"
-            }
-        ],
-        "overall_score_summary_title": "✅ 總分統計與等第建議",
-        "score_breakdown_table": [
-            {
-            "section": "I. Vocabulary & Grammar",
-            "max_score": "[根據考卷上的配分]",
-            "obtained_score": "[計算此部分得分]"
-            },
-            {
-            "section": "II. Cloze Test",
-            "max_score": "[根據考卷上的配分]",
-            "obtained_score": "[計算此部分得分]"
-            },
-            {
-            "section": "III. Reading Comprehension",
-            "max_score": "[根據考卷上的配分]",
-            "obtained_score": "[計算此部分得分]"
-            },
-            {
-            "section": "IV. Write",
-            "max_score": "[根據考卷上的配分]",
-            "obtained_score": "[計算此部分得分]"
-            }
-        ],
-        "final_total_score_text": "總分：100 學生分數：[學生得分]",
-        "final_suggested_grade_title": "🔺等第建議",
-        "final_suggested_grade_text": "[根據總分生成建議等第與說明]",
-        "overall_feedback_title": "📚 總結性回饋建議（可複製給學生）",
-        "overall_feedback": "[針對學生考卷的作答整體表現生成正面總結性回饋]"
-        }
+
+# 放在學生作業圖片之前的說明文字 (固定內容，建立一次即可)
+STUDENT_IMAGES_PREAMBLE = Part.from_text("以下是學生提交的原始作業圖片，供您參考其版面和手寫內容：")
+GEMINI_ONLY_OCR_PREAMBLE = Part.from_text("以下是學生提交的原始作業圖片，請直接從圖片中辨識學生的作業內容：")
+
+# 從 Gemini 回應中擷取被 ```json ... ``` (或未標註語言的 ``` ... ```) 包裹的 JSON 內容
+JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.DOTALL)
+
+# --- GCS 上的 Prompt 模板與參考答案檔名對照 (模組層級常數，不必每個請求重建) ---
+PROMPT_BASE_PATH = "ai_english_prompt/"
+ANSWER_BASE_PATH = "ai_english_file/"
+PROMPT_MAP = {
+    "段落寫作評閱": "段落寫作評閱.txt",
+    "測驗寫作評改": "測驗寫作評改.txt",
+    "學習單批改": "學習單批改.txt",
+    "讀寫習作評分": "讀寫習作評分.txt",
+}
+WORKSHEET_ANSWER_MAP = {
+    "七年級全英提問學習單參考答案": "全英提問學習單參考答案(01_1下).txt",
+    "八年級全英提問學習單參考答案": "全英提問學習單參考答案(01_2下).txt",
+    "九年級全英提問學習單參考答案": "全英提問學習單參考答案(01_3下).txt",
+    "七年級差異化學習單參考答案": "差異化學習單參考答案(01_1下).txt",
+    "八年級差異化學習單參考答案": "差異化學習單參考答案(01_2下).txt",
+    "九年級差異化學習單參考答案": "差異化學習單參考答案(01_3下).txt",
+}
+READ_WRITE_ANSWER_MAP = {
+    "七年級讀寫習作參考答案": "113_1習作標準答案.txt",
+    "八年級讀寫習作參考答案": "113_2習作標準答案.txt",
+    "九年級讀寫習作參考答案": "113_3習作標準答案.txt",
+}
+
+# --- 用於生成 JSON 結構的模擬數據 (存放於 prompts/ 下的 JSON 檔，首次建立 Prompt 時才載入) ---
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
+MOCK_STRUCTURE_FILES = {
+    '測驗寫作評改': "mock_quiz.json",
+    '段落寫作評閱': "mock_paragraph.json",
+    '學習單批改': "mock_learning_sheet.json",
+    '讀寫習作評分': "mock_reading_writing.json",
+}
+
+@functools.lru_cache(maxsize=None)
+def load_mock_structure(filename: str) -> Dict[str, Any]:
+    """讀取並快取 prompts/ 目錄下的 JSON 結構範例。"""
+    with open(os.path.join(PROMPTS_DIR, filename), "rb") as f:
+        return orjson.loads(f.read())
 
 
 # ==============================================================================
 # 4. 異步輔助函數 (保持不變)
 # ==============================================================================
 
-async def perform_ocr(image_file: UploadFile) -> str:
-    # ... (此函式保持不變)
-    if not image_file or not image_file.filename:
-        return "OCR_ERROR: 未提供圖片檔案。"
+# Vision API 的 batch_annotate_images 單次最多接受 16 張圖片
+VISION_BATCH_SIZE = 16
+
+# 上傳檔案大小不明時，分塊讀取的區塊大小
+UPLOAD_READ_CHUNK_SIZE = 1024 * 1024
+
+async def read_capped(file: UploadFile, cap: int) -> bytes:
+    """讀取上傳檔案，超過 cap 位元組時立即以 413 拒絕，不會把超大檔案整個讀進記憶體。"""
+    too_large = HTTPException(status_code=413, detail=f"檔案 {file.filename} 超過 {cap // (1024 * 1024)} MB 的大小上限。")
+    if file.size is not None:
+        if file.size > cap:
+            raise too_large
+        return await file.read()
+
+    # 大小不明時分塊讀取，一旦超過上限就停止
+    buffer = bytearray()
+    while chunk := await file.read(UPLOAD_READ_CHUNK_SIZE):
+        buffer += chunk
+        if len(buffer) > cap:
+            raise too_large
+    return bytes(buffer)
+
+async def read_upload_files(files: List[UploadFile]) -> List[bytes]:
+    """同時讀取所有上傳檔案 (每個檔案只讀一次)，並立即釋放其暫存檔。"""
     try:
-        print(f"  [OCR] 正在處理檔案: {image_file.filename} (大小: {image_file.size} bytes)")
-        content = await image_file.read()
-        image = vision.Image(content=content)
-        response = vision_client.text_detection(image=image)
-        
-        if response.error.message:
-            raise Exception(f"Vision API 錯誤: {response.error.message}")
-        
-        ocr_text = response.text_annotations[0].description if response.text_annotations else ""
-        print(f"  [OCR] 完成。識別出 {len(ocr_text)} 個字符。")
-        return ocr_text
-        
+        # 大於 1 MB 的檔案會落在磁碟上，讀取時會進入執行緒池
+        contents = await asyncio.gather(*[read_capped(file, settings.max_upload_bytes) for file in files])
+    finally:
+        for file in files:
+            # 內容已取出，立即釋放上傳檔案的暫存 (SpooledTemporaryFile)，不必等到請求結束
+            await file.close()
+    return list(contents)
+
+# 大於此大小的圖片在傳給 Gemini 前重新壓縮為 JPEG，縮小請求主體 (OCR 仍使用原始圖片)
+GEMINI_IMAGE_RECOMPRESS_THRESHOLD = 512 * 1024
+GEMINI_IMAGE_JPEG_QUALITY = 85
+
+def compress_image_for_gemini(content: bytes, mime_type: str) -> tuple:
+    """(同步，於執行緒池中執行) 回傳 (圖片 bytes, mime_type)；壓縮失敗或沒有變小時沿用原圖。"""
+    if len(content) <= GEMINI_IMAGE_RECOMPRESS_THRESHOLD:
+        return content, mime_type
+    try:
+        with Image.open(io.BytesIO(content)) as img:
+            # 手機拍攝的照片靠 EXIF 記錄方向，轉存 JPEG 前先套用，避免圖片被轉向
+            img = ImageOps.exif_transpose(img)
+            if "A" in img.getbands() or "transparency" in img.info:
+                # JPEG 沒有透明通道：直接 convert("RGB") 會讓透明背景變成黑色，先貼到白色底圖上
+                rgba = img.convert("RGBA")
+                rgb = Image.new("RGB", rgba.size, "white")
+                rgb.paste(rgba, mask=rgba.getchannel("A"))
+            else:
+                rgb = img.convert("RGB")
+            buffer = io.BytesIO()
+            rgb.save(buffer, format="JPEG", quality=GEMINI_IMAGE_JPEG_QUALITY, optimize=True)
     except Exception as e:
-        print(f"  !!! ERROR in perform_ocr !!!")
-        traceback.print_exc() # 打印詳細的錯誤堆疊
-        return f"OCR_ERROR: {str(e)}"
+        logger.warning("  [圖片] 無法重新壓縮圖片，改用原始檔案: %s", e)
+        return content, mime_type
+    compressed = buffer.getvalue()
+    if len(compressed) >= len(content):
+        return content, mime_type
+    logger.info("  [圖片] 已重新壓縮: %d -> %d bytes", len(content), len(compressed))
+    return compressed, "image/jpeg"
+
+async def build_image_parts(files: List[UploadFile], contents: List[bytes]) -> List[Part]:
+    """在執行緒池中同時壓縮所有圖片，回傳要傳給 Gemini 的 Part 列表。"""
+    prepared = await asyncio.gather(
+        *[run_in_threadpool(compress_image_for_gemini, content, file.content_type) for file, content in zip(files, contents)]
+    )
+    return [Part.from_data(data=data, mime_type=mime_type) for data, mime_type in prepared]
+
+async def perform_ocr_batch(image_contents: List[bytes]) -> List[str]:
+    """以 batch_annotate_images 合併多張圖片的 OCR 請求，回傳與輸入順序一致的文字列表。"""
+    ocr_texts: List[str] = ["OCR_ERROR: 未提供圖片檔案。"] * len(image_contents)
+    pending: List[tuple] = []  # (在 image_contents 中的索引, AnnotateImageRequest)
+    for index, content in enumerate(image_contents):
+        if not content:
+            continue
+        logger.info("  [OCR] 正在處理第 %d 張圖片 (大小: %d bytes)", index + 1, len(content))
+        pending.append((index, vision.AnnotateImageRequest(
+            image=vision.Image(content=content),
+            # 【修改】手寫作業掃描屬於密集文字，DOCUMENT_TEXT_DETECTION 的版面還原比 TEXT_DETECTION 好
+            features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)],
+        )))
+
+    # Vision 客戶端在 lifespan 中建立；建立失敗時每張圖片都標記為 OCR 錯誤，而不是讓整個請求變成 500
+    vision_client = getattr(app.state, "vision_client", None)
+    if vision_client is None:
+        for index, _ in pending:
+            ocr_texts[index] = "OCR_ERROR: Vision 客戶端未初始化。"
+        return ocr_texts
+
+    # 超過 16 張時拆成多個批次並同時送出，總耗時取決於最慢的一批而非所有批次的總和
+    chunks = [pending[start:start + VISION_BATCH_SIZE] for start in range(0, len(pending), VISION_BATCH_SIZE)]
+    # 使用非同步客戶端，等待 Vision API 回應時不會阻塞事件迴圈
+    batch_responses = await asyncio.gather(
+        *[vision_client.batch_annotate_images(requests=[request for _, request in chunk]) for chunk in chunks],
+        return_exceptions=True
+    )
+
+    for chunk, batch_response in zip(chunks, batch_responses):
+        if isinstance(batch_response, Exception):
+            logger.error("  !!! ERROR in perform_ocr_batch !!!", exc_info=batch_response) # 記錄詳細的錯誤堆疊
+            for index, _ in chunk:
+                ocr_texts[index] = f"OCR_ERROR: {str(batch_response)}"
+            continue
+
+        for (index, _), response in zip(chunk, batch_response.responses):
+            if response.error.message:
+                ocr_texts[index] = f"OCR_ERROR: Vision API 錯誤: {response.error.message}"
+                continue
+            ocr_text = response.full_text_annotation.text
+            logger.info("  [OCR] 完成。識別出 %d 個字符。", len(ocr_text))
+            ocr_texts[index] = ocr_text
+
+    return ocr_texts
+
+# GCS 上的 Prompt 模板/標準答案只會隨部署更新，讀取後在程序內快取一段時間
+GCS_CACHE_TTL_SECONDS = 300
+_gcs_text_cache: Dict[tuple, tuple] = {}  # (bucket_name, file_path) -> (到期時間, 文字內容, generation)
+_gcs_inflight: Dict[tuple, asyncio.Task] = {}  # (bucket_name, file_path) -> 進行中的下載
 
 async def get_gcs_blob_text(bucket_name: str, file_path: str) -> Optional[str]:
-    # ... (此函式保持不變)
+    cache_key = (bucket_name, file_path)
+    cached = _gcs_text_cache.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    # 同一檔案的並發快取未命中 (例如整班同時送出作業) 共用同一次下載
+    task = _gcs_inflight.get(cache_key)
+    if task is None:
+        task = asyncio.create_task(_download_gcs_blob_text(bucket_name, file_path))
+        _gcs_inflight[cache_key] = task
+        task.add_done_callback(lambda _: _gcs_inflight.pop(cache_key, None))
+    # shield：單一請求被取消時不會連帶取消其他請求正在等待的下載
+    return await asyncio.shield(task)
+
+async def _download_gcs_blob_text(bucket_name: str, file_path: str) -> Optional[str]:
+    cache_key = (bucket_name, file_path)
+    stale = _gcs_text_cache.get(cache_key)
     try:
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(file_path)
-        print(f"  [GCS] 正在讀取: gs://{bucket_name}/{file_path}")
-        if not blob.exists():
-            print(f"  !!! ERROR in get_gcs_blob_text: 檔案不存在。")
+        logger.info("  [GCS] 正在讀取: gs://%s/%s", bucket_name, file_path)
+        # storage 客戶端是同步的，整段讀取流程在執行緒池中一次完成，以免阻塞事件迴圈
+        result = await run_in_threadpool(_fetch_gcs_blob_text, bucket_name, file_path, stale[2] if stale else None)
+        if result is None:
+            logger.error("  !!! ERROR in get_gcs_blob_text: 檔案不存在。")
             return None
-        
-        text_content = blob.download_as_text()
-        print(f"  [GCS] 成功讀取 {len(text_content)} 個字符。")
+
+        generation, text_content = result
+        if text_content is None:
+            # 快取已過期但檔案的 generation 沒變：只延長快取時間，不重新下載內容
+            _gcs_text_cache[cache_key] = (time.monotonic() + GCS_CACHE_TTL_SECONDS, stale[1], generation)
+            return stale[1]
+
+        logger.info("  [GCS] 成功讀取 %d 個字符。", len(text_content))
+        _gcs_text_cache[cache_key] = (time.monotonic() + GCS_CACHE_TTL_SECONDS, text_content, generation)
         return text_content
 
     except Exception as e:
-        print(f"  !!! ERROR in get_gcs_blob_text !!!")
-        traceback.print_exc()
+        logger.exception("  !!! ERROR in get_gcs_blob_text !!!")
         return None
     
-async def get_standard_answer_from_gcs(
+def _fetch_gcs_blob_text(bucket_name: str, file_path: str, cached_generation: Optional[int]) -> Optional[tuple]:
+    """(同步，於執行緒池中執行) 回傳 (generation, 文字內容)；generation 與快取相同時內容為 None，檔案不存在時回傳 None。"""
+    # get_blob 只取中繼資料 (含 generation)；檔案不存在時回傳 None
+    blob = storage_client.bucket(bucket_name).get_blob(file_path)
+    if blob is None:
+        return None
+    if blob.generation == cached_generation:
+        return blob.generation, None
+    return blob.generation, blob.download_as_text()
+
+async def load_standard_answers(
     bucket_name: str,
     base_path: str,
     grade_level: str,
     category_key: str,
-    answer_map: Dict[str, str],
-    lookup_key: str
-) -> Optional[Dict[str, Any]]:
-    # ... (此函式保持不變)
-    """從 GCS 獲取指定主題的標準答案 JSON。"""
+    answer_map: Dict[str, str]
+) -> Optional[Dict[str, str]]:
+    """從 GCS 載入整份標準答案 JSON，回傳 {主題: 該主題答案的 JSON 字串} (同一份檔案內容只處理一次)。"""
     file_key = f"{grade_level}{category_key}"
     target_filename = answer_map.get(file_key)
     if not target_filename:
-        print(f"錯誤: 找不到對應的標準答案檔案，鍵值為 '{file_key}'。")
+        logger.error("錯誤: 找不到對應的標準答案檔案，鍵值為 '%s'。", file_key)
         return None
     
     full_path = f"{base_path}{target_filename}"
@@ -592,37 +587,171 @@ async def get_standard_answer_from_gcs(
         return None
         
     try:
-        all_data = json.loads(json_content)
-        lesson_data = all_data.get(lookup_key)
-        
-        if not lesson_data:
-            print(f"警告: 在檔案 {target_filename} 中找不到鍵 '{lookup_key}'。")
-            return None
-        
-        print(f"成功為 {lookup_key} 載入標準答案。")
-        return lesson_data
-    except json.JSONDecodeError as e:
-        print(f"解析 GCS 的 JSON 檔案時出錯 ({full_path}): {e}")
+        return parse_standard_answers(json_content)
+    except orjson.JSONDecodeError as e:
+        logger.error("解析 GCS 的 JSON 檔案時出錯 (%s): %s", full_path, e)
+        return None
+
+async def prefetch_gcs_files() -> None:
+    """啟動時預先載入所有 Prompt 模板與標準答案檔案，讓第一批請求就能命中快取。"""
+    prompt_paths = [f"{PROMPT_BASE_PATH}{name}" for name in PROMPT_MAP.values()]
+    answer_paths = [f"{ANSWER_BASE_PATH}{name}" for answer_map in (WORKSHEET_ANSWER_MAP, READ_WRITE_ANSWER_MAP) for name in answer_map.values()]
+    # get_gcs_blob_text 失敗時只記錄錯誤並回傳 None，不會讓啟動失敗；請求時會再重試
+    contents = await asyncio.gather(*[get_gcs_blob_text(settings.gcs_prompt_bucket_name, path) for path in prompt_paths + answer_paths])
+
+    # 順便預先編譯模板、解析答案檔，這些結果都隨檔案內容快取
+    for template_text in contents[:len(prompt_paths)]:
+        if template_text:
+            compile_prompt_template(template_text)
+    for path, json_content in zip(answer_paths, contents[len(prompt_paths):]):
+        if json_content:
+            try:
+                parse_standard_answers(json_content)
+            except orjson.JSONDecodeError as e:
+                logger.error("解析 GCS 的 JSON 檔案時出錯 (%s): %s", path, e)
+    logger.info("已預先載入 %d/%d 個 GCS 檔案。", sum(1 for text in contents if text), len(contents))
+
+def get_standard_answer(all_data: Dict[str, str], lookup_key: str) -> Optional[str]:
+    """從已解析的標準答案中取出指定主題的內容；純字典查詢，不需要 await。"""
+    lesson_data = all_data.get(lookup_key)
+    if not lesson_data:
+        logger.warning("警告: 在標準答案檔案中找不到鍵 '%s'。", lookup_key)
         return None
     
+    logger.info("成功為 %s 載入標準答案。", lookup_key)
+    return lesson_data
+    
+@functools.lru_cache(maxsize=16)
+def parse_standard_answers(json_content: str) -> Dict[str, str]:
+    """解析標準答案檔案並將每個主題預先序列化成緊湊的 JSON 字串，結果隨檔案內容快取。"""
+    # 縮排對模型沒有意義，以緊湊格式輸出可減少 Prompt 的 token 數；空的答案視同不存在
+    return {key: orjson.dumps(value).decode() for key, value in orjson.loads(json_content).items() if value}
+
 def get_json_format_example(submission_type: str) -> str:
-    # ... (此函式保持不變)
     """根據提交類型返回對應的 JSON 格式範例字串。"""
-    examples = {
-        '測驗寫作評改': mock_quiz_data_for_structure,
-        '段落寫作評閱': mock_paragraph_data_for_structure,
-        '學習單批改': mock_learning_sheet_structure,
-        '讀寫習作評分': mock_reading_writing_structure,
-    }
     # 如果類型未知，默認為段落寫作
-    mock_data = examples.get(submission_type, mock_paragraph_data_for_structure)
-    return json.dumps(mock_data, ensure_ascii=False, indent=2)
+    filename = MOCK_STRUCTURE_FILES.get(submission_type, MOCK_STRUCTURE_FILES['段落寫作評閱'])
+    return render_mock_structure(filename)
+
+@functools.lru_cache(maxsize=None)
+def render_mock_structure(filename: str) -> str:
+    """將 JSON 結構範例序列化一次並快取，之後組 Prompt 時直接使用同一個字串。"""
+    # 不縮排：縮排空白對模型理解結構沒有幫助，只會增加輸入 token
+    return orjson.dumps(load_mock_structure(filename)).decode()
+
+_PROMPT_FORMATTER = string.Formatter()
+
+@functools.lru_cache(maxsize=8)
+def compile_prompt_template(template_text: str) -> tuple:
+    """將 Prompt 模板拆成 (文字片段, 欄位名稱, 格式, 轉換) 的序列；同一版模板只解析一次。"""
+    return tuple(_PROMPT_FORMATTER.parse(template_text))
+
+def render_prompt_template(template_text: str, **values: str) -> str:
+    """與 template_text.format(**values) 結果相同，但不必每個請求重新掃描模板中的 {欄位}。"""
+    pieces = []
+    for literal_text, field_name, format_spec, conversion in compile_prompt_template(template_text):
+        pieces.append(literal_text)
+        if field_name is not None:
+            value = values[field_name]
+            if conversion:
+                value = _PROMPT_FORMATTER.convert_field(value, conversion)
+            pieces.append(format(value, format_spec) if format_spec else value)
+    return "".join(pieces)
+
+def salvage_json_text(text: str) -> Optional[str]:
+    """修復常見的 JSON 格式問題：截掉結尾多餘的文字、補上缺少的括號、移除多餘的逗號。找不到 '{' 時回傳 None。"""
+    start = text.find('{')
+    if start == -1:
+        return None
+
+    closers: List[str] = []
+    in_string = escaped = False
+    end = len(text)
+    pending_comma: Optional[int] = None  # 字串外最近的逗號，若其後緊接 } 或 ] 就是多餘的逗號
+    dropped_commas: List[int] = []
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+            pending_comma = None
+        elif char == ',':
+            pending_comma = index
+        elif char in '{[':
+            closers.append('}' if char == '{' else ']')
+            pending_comma = None
+        elif char in '}]':
+            if pending_comma is not None:
+                dropped_commas.append(pending_comma)
+                pending_comma = None
+            if not closers or closers.pop() != char:
+                return None
+            if not closers:
+                # 最外層的物件已經結束，之後的內容 (例如補充說明) 全部捨棄
+                end = index + 1
+                break
+        elif not char.isspace():
+            pending_comma = None
+
+    if closers and pending_comma is not None:
+        # 回應在逗號之後被截斷，補上的括號前同樣不能有逗號
+        dropped_commas.append(pending_comma)
+
+    # 只移除掃描時判定為多餘的逗號，字串內容保持原樣
+    pieces: List[str] = []
+    position = start
+    for comma_index in dropped_commas:
+        pieces.append(text[position:comma_index])
+        position = comma_index + 1
+    pieces.append(text[position:end])
+    candidate = "".join(pieces)
+
+    if closers:
+        # 回應被截斷：補上未結束的字串與括號
+        if in_string:
+            candidate += '"'
+        else:
+            candidate = candidate.rstrip()
+        candidate += "".join(reversed(closers))
+    return candidate
+
+async def stream_gemini_ndjson(contents_for_gemini: List[Part]):
+    """以串流方式呼叫 Gemini，逐塊轉送生成的文字，每行一個 JSON 物件 (NDJSON)。"""
+    try:
+        responses = await gemini_model.generate_content_async(
+            contents_for_gemini,
+            stream=True
+        )
+        async for chunk in responses:
+            if not chunk.candidates:
+                if chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
+                    reason = chunk.prompt_feedback.block_reason.name
+                    yield orjson.dumps({"error": f"AI 模型未返回任何內容，可能已被安全設定阻擋。原因: {reason}"}) + b"\n"
+                continue
+            chunk_text = "".join(part.text for part in chunk.candidates[0].content.parts)
+            if chunk_text:
+                yield orjson.dumps({"text": chunk_text}) + b"\n"
+    except Exception as e:
+        logger.exception("  !!! ERROR in stream_gemini_ndjson !!!")
+        yield orjson.dumps({"error": f"串流呼叫 Gemini 時發生錯誤: {str(e)}"}) + b"\n"
 
 # ==============================================================================
 # 5. 主要 API 路由 (【重大修改】)
 # ==============================================================================
 
-@app.post("/api/grade", response_model=ApiResponse, tags=["評分"])
+# 日誌中的請求開始/錯誤橫幅 (固定字串，只在匯入時組合一次)
+REQUEST_START_BANNER = "\n" + "="*80 + "\n||" + " " * 28 + "開始處理新的評分請求" + " " * 28 + "||\n" + "="*80 + "\n"
+REQUEST_ERROR_BANNER = "\n" + "!"*80 + "\n!!!" + " " * 31 + "請求處理時發生錯誤" + " " * 31 + "!!!\n" + "!"*80 + "\n"
+
+# response_model=None：回應已由 TypeAdapter 驗證並序列化，FastAPI 不需再建立/執行回應驗證；
+# 透過 responses 保留 OpenAPI 文件中的回應結構
+@app.post("/api/grade", response_model=None, responses={200: {"model": ApiResponse}}, tags=["評分"])
 async def grade_writing(
     # --- 路由參數保持不變 ---
     submissionType: str = Form(..., description="提交類型"),
@@ -636,21 +765,42 @@ async def grade_writing(
     essayImage: List[UploadFile] = File([], description="作文圖片檔案"),
     learningSheetFile: List[UploadFile] = File([], description="學習單圖片檔案"),
     readingWritingFile: List[UploadFile] = File([], description="讀寫習作圖片檔案"),
-    standardAnswerImage: List[UploadFile] = File([], description="標準答案圖片檔案")
+    standardAnswerImage: List[UploadFile] = File([], description="標準答案圖片檔案"),
+    stream: bool = Query(False, description="以 NDJSON 串流回傳 Gemini 的原始輸出 (不做 JSON 驗證)")
 ):
-    print("\n" + "="*80)
-    print("||" + " " * 28 + "開始處理新的評分請求" + " " * 28 + "||")
-    print("="*80 + "\n")
+    logger.info(REQUEST_START_BANNER)
 
     try:
         # --- 階段 1 到 5: 準備工作 (將原程式碼複製到這裡) ---
         # (此處省略了從 "階段 1" 到 "階段 5" 的所有程式碼，因為它們保持不變)
         # 確保在執行完這些步驟後，您已經準備好了 `contents_for_gemini` 列表。
         # --- START of PREPARATION CODE ---
-        print("--- [1. 接收到的請求參數] ---")
-        print(f"  - submissionType: {submissionType}")
+        logger.info("--- [1. 接收到的請求參數] ---")
+        logger.info("  - submissionType: %s", submissionType)
         # ... (複製您原有的所有參數打印)
 
+        prompt_file = PROMPT_MAP.get(submissionType)
+        if not prompt_file: raise HTTPException(status_code=400, detail=f"不支持的提交類型: {submissionType}")
+        prompt_path = f"{PROMPT_BASE_PATH}{prompt_file}"
+        # 【新增】Prompt 模板與 OCR 彼此獨立，先在背景開始從 GCS 下載模板，與後續的 OCR 同時進行
+        prompt_task = asyncio.create_task(get_gcs_blob_text(settings.gcs_prompt_bucket_name, prompt_path))
+
+        # 【新增】GCS 結構化答案同樣不依賴 OCR 結果，也提前在背景開始載入 (於階段 4 取用)
+        standard_answers_task = None
+        standard_answers_lookup_key = ""
+        if submissionType == '學習單批改' and learnsheets and worksheetCategory:
+            standard_answers_lookup_key = learnsheets
+            standard_answers_task = asyncio.create_task(load_standard_answers(
+                settings.gcs_prompt_bucket_name, ANSWER_BASE_PATH, gradeLevel, 
+                worksheetCategory, WORKSHEET_ANSWER_MAP
+            ))
+        elif submissionType == '讀寫習作評分' and bookrange:
+            standard_answers_lookup_key = bookrange
+            standard_answers_task = asyncio.create_task(load_standard_answers(
+                settings.gcs_prompt_bucket_name, ANSWER_BASE_PATH, gradeLevel, 
+                "讀寫習作參考答案", READ_WRITE_ANSWER_MAP
+            ))
+
         contents_for_gemini: List[Part] = []
         essay_content = ""
         
@@ -659,102 +809,82 @@ async def grade_writing(
         elif submissionType == '學習單批改': student_files = learningSheetFile
         elif submissionType == '讀寫習作評分': student_files = readingWritingFile
         
-        print("--- [2. 處理學生作業內容 (OCR 或文字)] ---")
+        logger.info("--- [2. 處理學生作業內容 (OCR 或文字)] ---")
         if text:
             essay_content = text
-            print("  - 使用了純文字輸入。")
+            logger.info("  - 使用了純文字輸入。")
         elif student_files:
-            print("  - 正在處理上傳的圖片檔案...")
-            ocr_results = []
-            # 【修改】使用 asyncio.gather 並行處理 OCR，提高效率
-            ocr_tasks = [perform_ocr(file) for file in student_files]
-            all_ocr_texts = await asyncio.gather(*ocr_tasks)
-
-            contents_for_gemini.append(Part.from_text("以下是學生提交的原始作業圖片，供您參考其版面和手寫內容："))
-            for i, file in enumerate(student_files):
-                ocr_text = all_ocr_texts[i]
-                if "OCR_ERROR:" not in ocr_text and ocr_text.strip():
-                    ocr_results.append(ocr_text)
-                await file.seek(0)
-                image_data = await file.read()
-                contents_for_gemini.append(Part.from_data(data=image_data, mime_type=file.content_type))
-            
-            if not ocr_results: raise HTTPException(status_code=400, detail="所有圖片的 OCR 均失敗，且未提供純文字輸入。")
-            essay_content = "\n\n".join(ocr_results)
+            logger.info("  - 正在處理上傳的圖片檔案...")
+            # 每個檔案只讀取一次，同一份 bytes 同時用於 OCR 與傳給 Gemini
+            student_contents = await read_upload_files(student_files)
+            # 【新增】傳給 Gemini 的圖片在執行緒池中壓縮，與 OCR 同時進行
+            image_parts_coro = build_image_parts(student_files, student_contents)
+
+            if settings.use_gemini_only_ocr:
+                # 【新增】Gemini 本身已收到圖片，省略學生作業的 OCR
+                logger.info("  - 已啟用 USE_GEMINI_ONLY_OCR，略過學生作業圖片的 OCR。")
+                image_parts = await image_parts_coro
+                contents_for_gemini.append(GEMINI_ONLY_OCR_PREAMBLE)
+                contents_for_gemini.extend(image_parts)
+            else:
+                # 【修改】以單一批次請求完成所有圖片的 OCR，減少 RPC 往返次數
+                all_ocr_texts, image_parts = await asyncio.gather(perform_ocr_batch(student_contents), image_parts_coro)
+
+                contents_for_gemini.append(STUDENT_IMAGES_PREAMBLE)
+                contents_for_gemini.extend(image_parts)
+                ocr_results = [t for t in all_ocr_texts if "OCR_ERROR:" not in t and t.strip()]
+                
+                if not ocr_results: raise HTTPException(status_code=400, detail="所有圖片的 OCR 均失敗，且未提供純文字輸入。")
+                essay_content = "\n\n".join(ocr_results)
         else:
             raise HTTPException(status_code=400, detail=f"對於 '{submissionType}'，必須提供純文字輸入或圖片檔案。")
         
-        print(f"\n  [作業內容預覽 (前 300 字)]:\n---\n{essay_content[:300]}\n---\n")
+        # 【修改】預覽只在 DEBUG 等級輸出，未啟用時連字串切片都省略
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("\n  [作業內容預覽 (前 300 字)]:\n---\n%s\n---\n", essay_content[:300])
 
         # ... (複製您原有的 "階段 3", "階段 4", "階段 5" 的所有程式碼)
         # --- 階段 3: 處理標準答案 (若有) ---
-        print("--- [3. 處理標準答案] ---")
+        logger.info("--- [3. 處理標準答案] ---")
         processed_standard_answer = ""
         if submissionType == '測驗寫作評改':
             if standardAnswerText:
                 processed_standard_answer = standardAnswerText
-                print("  - 使用了純文字輸入的標準答案。")
+                logger.info("  - 使用了純文字輸入的標準答案。")
             elif standardAnswerImage:
-                print("  - 正在處理上傳的標準答案圖片...")
+                logger.info("  - 正在處理上傳的標準答案圖片...")
                 # ... (此處省略 OCR 邏輯，與上面類似) ...
             else:
-                print("  - 無標準答案提供。")
+                logger.info("  - 無標準答案提供。")
         else:
-            print("  - 此提交類型無需標準答案。")
+            logger.info("  - 此提交類型無需標準答案。")
         
-        if processed_standard_answer:
-            print(f"\n  [標準答案預覽 (前 200 字)]:\n---\n{processed_standard_answer[:200]}\n---\n")
+        if processed_standard_answer and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("\n  [標準答案預覽 (前 200 字)]:\n---\n%s\n---\n", processed_standard_answer[:200])
 
         # --- 階段 4: 從 GCS 獲取結構化答案 (若有) ---
-        print("--- [4. 從 GCS 獲取結構化答案] ---")
+        logger.info("--- [4. 從 GCS 獲取結構化答案] ---")
         standard_answers_json_str = ""
 
-        if submissionType == '學習單批改' and learnsheets and worksheetCategory:
-            print(f"  - 條件滿足，嘗試為「學習單批改」載入答案...")
-            answer_map = { 
-                "七年級全英提問學習單參考答案":"全英提問學習單參考答案(01_1下).txt", 
-                "八年級全英提問學習單參考答案":"全英提問學習單參考答案(01_2下).txt", 
-                "九年級全英提問學習單參考答案":"全英提問學習單參考答案(01_3下).txt", 
-                "七年級差異化學習單參考答案":"差異化學習單參考答案(01_1下).txt", 
-                "八年級差異化學習單參考答案":"差異化學習單參考答案(01_2下).txt", 
-                "九年級差異化學習單參考答案":"差異化學習單參考答案(01_3下).txt" 
-            }
-            standard_answers_data = await get_standard_answer_from_gcs(
-                GCS_PROMPT_BUCKET_NAME, "ai_english_file/", gradeLevel, 
-                worksheetCategory, answer_map, learnsheets
-            )
-            if standard_answers_data:
-                standard_answers_json_str = json.dumps(standard_answers_data, ensure_ascii=False, indent=2)
+        if standard_answers_task is not None:
+            logger.info("  - 條件滿足，等待「%s」的答案載入完成...", submissionType)
+            all_standard_answers = await standard_answers_task
+            if all_standard_answers:
+                # 【修改】答案在載入時已序列化好，直接放入 Prompt
+                standard_answers_json_str = get_standard_answer(all_standard_answers, standard_answers_lookup_key) or ""
 
-        elif submissionType == '讀寫習作評分' and bookrange:
-            print(f"  - 條件滿足，嘗試為「讀寫習作評分」載入答案...")
-            answer_map = { 
-                "七年級讀寫習作參考答案": "113_1習作標準答案.txt", 
-                "八年級讀寫習作參考答案": "113_2習作標準答案.txt", 
-                "九年級讀寫習作參考答案": "113_3習作標準答案.txt" 
-            }
-            standard_answers_data = await get_standard_answer_from_gcs(
-                GCS_PROMPT_BUCKET_NAME, "ai_english_file/", gradeLevel, 
-                "讀寫習作參考答案", answer_map, bookrange
-            )
-            if standard_answers_data:
-                standard_answers_json_str = json.dumps(standard_answers_data, ensure_ascii=False, indent=2)
-
-        if standard_answers_json_str:
-            print(f"\n  [GCS 答案預覽 (前 200 字)]:\n---\n{standard_answers_json_str[:200]}\n---\n")
-        else:
-            print("  - 無需或未找到 GCS 結構化答案。\n")
+        if not standard_answers_json_str:
+            logger.info("  - 無需或未找到 GCS 結構化答案。")
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug("\n  [GCS 答案預覽 (前 200 字)]:\n---\n%s\n---\n", standard_answers_json_str[:200])
 
         # --- 階段 5: 準備並打印最終 Prompt ---
-        print("--- [5. 準備最終 Prompt] ---")
-        prompt_map = { "段落寫作評閱": "段落寫作評閱.txt", "測驗寫作評改": "測驗寫作評改.txt", "學習單批改": "學習單批改.txt", "讀寫習作評分": "讀寫習作評分.txt" }
-        prompt_file = prompt_map.get(submissionType)
-        if not prompt_file: raise HTTPException(status_code=400, detail=f"不支持的提交類型: {submissionType}")
-        prompt_path = f"ai_english_prompt/{prompt_file}"
-        base_prompt_text = await get_gcs_blob_text(GCS_PROMPT_BUCKET_NAME, prompt_path)
+        logger.info("--- [5. 準備最終 Prompt] ---")
+        base_prompt_text = await prompt_task
         if not base_prompt_text: raise HTTPException(status_code=500, detail="從 GCS 載入 Prompt 模板失敗。")
         
-        final_prompt_text = base_prompt_text.format(
+        final_prompt_text = render_prompt_template(
+            base_prompt_text,
             Book=bookrange or "", learnsheet=learnsheets or "", grade_level=gradeLevel,
             submission_type=submissionType, essay_content=essay_content,
             standard_answer_if_any=processed_standard_answer,
@@ -764,80 +894,90 @@ async def grade_writing(
         )
         contents_for_gemini.insert(0, Part.from_text(final_prompt_text))
         
-        prompt_preview = final_prompt_text.split("JSON 輸出格式範例：")[0]
-        print("\n  [最終 Prompt 預覽 (發送給 Gemini 的內容)]:")
-        print("-" * 50)
-        print(prompt_preview)
-        print("-" * 50 + "\n")
+        if logger.isEnabledFor(logging.DEBUG):
+            prompt_preview = final_prompt_text.split("JSON 輸出格式範例：")[0]
+            logger.debug("\n  [最終 Prompt 預覽 (發送給 Gemini 的內容)]:\n%s\n%s\n%s\n", "-" * 50, prompt_preview, "-" * 50)
         # --- END of PREPARATION CODE ---
 
         # --- 【修改】階段 6: 使用非阻塞方式呼叫 Gemini API ---
-        print("--- [6. 呼叫 Gemini API] ---")
-        generation_config = { "temperature": 0.1, "top_p": 0.5, "max_output_tokens": 16348}
-        safety_settings = {
-            HarmCategory.HARM_CATEGORY_UNSPECIFIED: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-        }
-        
-        print("  - 正在背景執行緒中發送請求...")
-        # 【修改】使用 asyncio.to_thread 執行同步函式，避免阻塞
-        response = await asyncio.to_thread(
-            gemini_model.generate_content,
+        logger.info("--- [6. 呼叫 Gemini API] ---")
+        if stream:
+            # 串流模式：邊生成邊回傳，縮短客戶端收到第一個位元組的時間
+            logger.info("  - 以串流模式回傳 Gemini 輸出。")
+            return StreamingResponse(stream_gemini_ndjson(contents_for_gemini), media_type="application/x-ndjson")
+
+        logger.info("  - 正在發送請求...")
+        # 【修改】改用 SDK 原生的非同步介面，並以串流方式邊收邊累積文字；
+        # ```json 區塊一結束就停止接收，不必等模型把區塊後的補充說明也生成完
+        response_stream = await gemini_model.generate_content_async(
             contents_for_gemini,
-            generation_config=generation_config,
-            tools=tools_list,
-            safety_settings=safety_settings
+            stream=True
         )
-        print("  - 已收到 Gemini 回應。\n")
+        response = None
+        prompt_feedback = None
+        text_chunks: List[str] = []
+        json_match = None
+        async for response in response_stream:
+            # 保留第一個非空的 prompt_feedback，供判斷是否被安全設定攔截
+            if prompt_feedback is None and getattr(response, "prompt_feedback", None):
+                prompt_feedback = response.prompt_feedback
+            if not response.candidates:
+                # 沒有 candidates 的區塊 (例如結尾只帶 usage metadata 的區塊) 直接略過，與串流路徑一致
+                continue
+            # ======================= 【重大修改】 =======================
+            # 手動遍歷 parts 列表，拼接所有文本內容，以應對 "Multiple content parts" 的情況
+            # 這比直接使用 response.text 更可靠
+            try:
+                chunk_text = "".join(part.text for part in response.candidates[0].content.parts)
+            except Exception as e:
+                # 如果在拼接過程中出現任何問題（雖然可能性很低），給出明確的錯誤
+                error_detail = f"從 AI 回應中提取文本時出錯: {e}. Response: {response}"
+                logger.error("!!! ERROR: %s", error_detail)
+                raise HTTPException(status_code=500, detail=error_detail)
+            # ==========================================================
+            text_chunks.append(chunk_text)
+            # 只有收到反引號時 JSON 區塊才可能剛結束，其餘區塊不必重新掃描整段文字
+            if "`" in chunk_text:
+                json_match = JSON_FENCE_RE.search("".join(text_chunks))
+                if json_match:
+                    await response_stream.aclose()
+                    break
+        logger.info("  - 已收到 Gemini 回應。")
 
         # --- 【修改】階段 7: 增強的 API 回應處理 ---
-        print("--- [7. 處理 API 回應] ---")
+        logger.info("--- [7. 處理 API 回應] ---")
 
-        print(f"  [DEBUG] 完整的 Gemini Response 物件: {response}") # 這行日誌仍然很有用，保留它
+        logger.debug("  [DEBUG] 最後一個 Gemini 串流區塊: %s", response) # 這行日誌仍然很有用，保留它 (%s 只在 DEBUG 啟用時才會格式化)
 
         # 【修改】更健壯的檢查，判斷是否被攔截
-        if not response.candidates:
+        if not text_chunks:
             reason = "未知原因"
-            if response.prompt_feedback and response.prompt_feedback.block_reason:
-                reason = response.prompt_feedback.block_reason.name
+            if prompt_feedback and prompt_feedback.block_reason:
+                reason = prompt_feedback.block_reason.name
             
             error_detail = f"AI 模型未返回任何內容，可能已被安全設定阻擋。原因: {reason}"
-            print(f"!!! ERROR: {error_detail}")
+            logger.error("!!! ERROR: %s", error_detail)
 
-            if response.prompt_feedback.safety_ratings:
-                print("  --- 安全評分詳情 ---")
-                for rating in response.prompt_feedback.safety_ratings:
-                    print(f"    - Category: {rating.category.name}, Probability: {rating.probability.name}")
-                print("  --------------------")
+            if prompt_feedback and prompt_feedback.safety_ratings:
+                logger.error("  --- 安全評分詳情 ---")
+                for rating in prompt_feedback.safety_ratings:
+                    logger.error("    - Category: %s, Probability: %s", rating.category.name, rating.probability.name)
             
             raise HTTPException(status_code=500, detail=error_detail)
 
-        # ======================= 【重大修改】 =======================
-        # 手動遍歷 parts 列表，拼接所有文本內容，以應對 "Multiple content parts" 的情況
-        # 這比直接使用 response.text 更可靠
-        try:
-            response_text = "".join(part.text for part in response.candidates[0].content.parts)
-        except Exception as e:
-            # 如果在拼接過程中出現任何問題（雖然可能性很低），給出明確的錯誤
-            error_detail = f"從 AI 回應中提取文本時出錯: {e}. Response: {response}"
-            print(f"!!! ERROR: {error_detail}")
-            raise HTTPException(status_code=500, detail=error_detail)
-        # ==========================================================
+        response_text = "".join(text_chunks)
 
-        print(f"  [Gemini 拼接後的回應預覽 (前 500 字)]:\n---\n{response_text[:500]}\n---\n")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("  [Gemini 拼接後的回應預覽 (前 500 字)]:\n---\n%s\n---\n", response_text[:500])
 
         # 檢查回應是否為空字串
         if not response_text.strip():
             error_detail = "AI 模型返回了空的文本內容，但未報告攔截。請檢查輸入或 Prompt。"
-            print(f"!!! ERROR: {error_detail}")
+            logger.error("!!! ERROR: %s", error_detail)
             raise HTTPException(status_code=500, detail=error_detail)
 
         # 【新增】從拼接後的文本中提取 JSON 內容
-        # 這個正則表達式可以處理被 ```json ... ``` 包裹的情況
-        json_match = re.search(r"```json\s*(\{.*?\})\s*```", response_text, re.DOTALL)
+        # 被 ```json ... ``` 包裹的情況已在接收串流時以正則表達式比對出來 (json_match)
         if json_match:
             cleaned_text = json_match.group(1)
         else:
@@ -851,44 +991,51 @@ async def grade_writing(
                  raise HTTPException(status_code=500, detail="AI 回應中未找到有效的 JSON 內容。")
 
         try:
-            ai_json = json.loads(cleaned_text)
-            print("  - JSON 解析成功，準備根據類型進行 Pydantic 驗證。")
+            try:
+                ai_json = orjson.loads(cleaned_text)
+            except orjson.JSONDecodeError as parse_error:
+                # 【新增】直接解析失敗時先嘗試修復一次，仍失敗才放棄這次 (昂貴的) Gemini 呼叫
+                salvaged_text = salvage_json_text(cleaned_text)
+                try:
+                    ai_json = orjson.loads(salvaged_text) if salvaged_text else None
+                except orjson.JSONDecodeError:
+                    ai_json = None
+                if ai_json is None:
+                    raise parse_error
+                logger.warning("  - 原始回應不是有效的 JSON，已自動修復後解析成功。")
+            logger.info("  - JSON 解析成功，準備根據類型進行 Pydantic 驗證。")
             
-            # ... 後續的 Pydantic 驗證和返回邏輯保持不變 ...
-            if submissionType == '段落寫作評閱':
-                return ParagraphResponse.model_validate(ai_json)
-            elif submissionType == '測驗寫作評改':
-                return QuizResponse.model_validate(ai_json)
-            elif submissionType in ['學習單批改', '讀寫習作評分']:
-                return WorksheetResponse.model_validate(ai_json)
-            else:
+            # 【修改】以字典查表取得驗證器，取代逐一比對提交類型的 if/elif
+            adapter = RESPONSE_ADAPTERS.get(submissionType)
+            if adapter is None:
                 return ai_json
 
-        except json.JSONDecodeError as e:
+            # 直接以 adapter 輸出 JSON bytes，略過 FastAPI 對回傳值的再次驗證與序列化
+            validated = adapter.validate_python(ai_json)
+            return Response(content=adapter.dump_json(validated), media_type="application/json")
+
+        except orjson.JSONDecodeError as e:
             error_detail = f"AI 模型返回的內容不是有效的 JSON 格式: {e}"
-            print(f"!!! ERROR: {error_detail}")
-            print(f"--- Gemini 格式錯誤的內容 ---")
-            print(cleaned_text) # 打印清理後的文本，更容易定位錯誤
-            print(f"------------------------------")
+            # 記錄清理後的文本，更容易定位錯誤
+            logger.error("!!! ERROR: %s\n--- Gemini 格式錯誤的內容 ---\n%s\n------------------------------", error_detail, cleaned_text)
             raise HTTPException(status_code=500, detail=error_detail)
         except ValidationError as e:
             error_detail = f"AI 返回的 JSON 結構不符合 Pydantic 模型要求: {e}"
-            print(f"!!! ERROR: {error_detail}")
-            print(f"--- Gemini 結構錯誤的 JSON ---")
-            print(json.dumps(ai_json, indent=2, ensure_ascii=False)) # 打印格式化的JSON以便檢查
-            print(f"------------------------------")
+            # 記錄格式化的 JSON 以便檢查
+            logger.error("!!! ERROR: %s\n--- Gemini 結構錯誤的 JSON ---\n%s\n------------------------------",
+                         error_detail, orjson.dumps(ai_json, option=orjson.OPT_INDENT_2).decode())
             raise HTTPException(status_code=500, detail=error_detail)
 
 
     except Exception as e:
         # 統一的錯誤處理
-        print("\n" + "!"*80)
-        print("!!!" + " " * 31 + "請求處理時發生錯誤" + " " * 31 + "!!!")
-        print("!"*80 + "\n")
-        traceback.print_exc()
+        logger.error(REQUEST_ERROR_BANNER)
         if isinstance(e, HTTPException):
+            # 預期中的錯誤 (例如輸入不完整)，不需要完整堆疊
+            logger.warning("請求失敗 (HTTP %s): %s", e.status_code, e.detail)
             raise e
         else:
+            logger.exception("請求處理時發生未預期的錯誤")
             raise HTTPException(status_code=500, detail=f"伺服器內部發生未知錯誤: {str(e)}")
 
 # ==============================================================================